@@ -0,0 +1,70 @@
+import ipaddress
+
+
+class CidrIndex(object):
+
+    # Networks are held in one hash table per prefix length, so a lookup costs one mask and one dict lookup for each
+    # prefix length in use (typically just /32 and /64) no matter how many networks are indexed.
+
+    def __init__(self):
+        # version -> prefix length -> network address (as int) -> value
+        self._tables = {4: {}, 6: {}}
+        # version -> prefix lengths in use, longest first
+        self._prefixes = {4: [], 6: []}
+
+    def __len__(self):
+        return sum(len(table) for tables in self._tables.values() for table in tables.values())
+
+    def __contains__(self, address):
+        for _ in self.matches(address):
+            return True
+        return False
+
+    def add(self, network, value=True):
+        network = _parse_network(network)
+        tables = self._tables[network.version]
+        try:
+            table = tables[network.prefixlen]
+        except KeyError:
+            table = tables[network.prefixlen] = {}
+            self._prefixes[network.version] = sorted(tables, reverse=True)
+        table[int(network.network_address)] = value
+
+    def get(self, network, default=None):
+        network = _parse_network(network)
+        try:
+            return self._tables[network.version][network.prefixlen][int(network.network_address)]
+        except KeyError:
+            return default
+
+    def discard(self, network):
+        network = _parse_network(network)
+        tables = self._tables[network.version]
+        table = tables.get(network.prefixlen)
+        if table is None:
+            return
+        table.pop(int(network.network_address), None)
+        if not table:
+            del tables[network.prefixlen]
+            self._prefixes[network.version] = sorted(tables, reverse=True)
+
+    def matches(self, address):
+        # Yields the value of every indexed network containing the address (or network), most specific first
+        network = _parse_network(address)
+        tables = self._tables[network.version]
+        address_int = int(network.network_address)
+        max_bits = network.max_prefixlen
+        for prefix_len in self._prefixes[network.version]:
+            if prefix_len > network.prefixlen:
+                continue
+            mask = ((1 << prefix_len) - 1) << (max_bits - prefix_len)
+            try:
+                yield tables[prefix_len][address_int & mask]
+            except KeyError:
+                pass
+
+
+def _parse_network(value):
+    if isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return value
+    return ipaddress.ip_network(value, strict=False)
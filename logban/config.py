@@ -1,31 +1,98 @@
-from configobj import ConfigObj
 from getopt import getopt
+import hashlib
+import json
 import os
 import os.path
 import re
 import logging
 
+import logban.plugins
+
 from logban.core import deep_merge_dict
 
 _logger = logging.getLogger(__name__)
 
 
+loaded_config_path = None
 core_config = {}
 filter_config = {}
 trigger_config = {}
+allowlist_config = {}
 
 
 def parse_args(args):
-    options, actions = getopt(args, '', ['config-path='])
+    options, actions = getopt(args, '', ['config-path=', 'config-cache='])
     return {option[2:].replace('-','_'): value for option, value in options}, actions
 
 
-def load_config_files(config_path='/etc/logban'):
-    global db_engine, core_config, filter_config, trigger_config
+def load_config_files(config_path='/etc/logban', config_cache='/var/cache/logban/config.json'):
+    global db_engine, loaded_config_path, core_config, filter_config, trigger_config, allowlist_config
+    loaded_config_path = config_path
+    if config_cache:
+        cache_key = _config_cache_key(config_path)
+        if _load_config_cache(config_cache, cache_key):
+            return
+    _load_config_into(config_path, core_config, filter_config, trigger_config, allowlist_config)
+    if config_cache:
+        _save_config_cache(config_cache, cache_key)
+
+
+def _config_cache_key(config_path):
+    # Any change to a config file, a plugin or this parser gives a new key
+    key = hashlib.sha256()
+    for root in (config_path, os.path.dirname(logban.plugins.__file__)):
+        for directory, sub_directories, file_names in os.walk(root):
+            sub_directories[:] = sorted(name for name in sub_directories if name != '__pycache__')
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                file_stat = os.stat(file_path)
+                key.update(("%s %d %d\n" % (file_path, file_stat.st_mtime_ns, file_stat.st_size)).encode('utf-8'))
+    key.update(str(os.stat(__file__).st_mtime_ns).encode('utf-8'))
+    return key.hexdigest()
+
+
+def _load_config_cache(config_cache, cache_key):
+    try:
+        with open(config_cache) as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return False
+    if cached.get('key') != cache_key:
+        return False
+    core_config.update(cached['core'])
+    filter_config.update(cached['filters'])
+    trigger_config.update(cached['triggers'])
+    allowlist_config.update(cached['allowlist'])
+    return True
+
+
+def _save_config_cache(config_cache, cache_key):
+    # Only a speed up, never stop startup because it can't be written
+    try:
+        temp_path = "%s.%d.tmp" % (config_cache, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'key': cache_key, 'core': core_config, 'filters': filter_config,
+                       'triggers': trigger_config, 'allowlist': allowlist_config}, cache_file)
+        os.replace(temp_path, config_cache)
+    except OSError as error:
+        _logger.debug("Could not save config cache %s: %s", config_cache, error)
+
+
+def reload_config_files():
+    # Load everything before touching the live config so a broken file leaves it untouched
+    new_configs = ({}, {}, {}, {})
+    _load_config_into(loaded_config_path, *new_configs)
+    for existing, new_config in zip((core_config, filter_config, trigger_config, allowlist_config), new_configs):
+        existing.clear()
+        existing.update(new_config)
+
+
+def _load_config_into(config_path, core, filters, triggers, allowlist):
     # Load core config
-    load_config_objects(core_config, os.path.join(config_path, 'logban.conf'))
-    load_config_filters(filter_config, os.path.join(config_path, 'filters'))
-    load_config_objects(trigger_config, os.path.join(config_path, 'triggers'))
+    load_config_objects(core, os.path.join(config_path, 'logban.conf'))
+    load_config_filters(filters, os.path.join(config_path, 'filters'))
+    load_config_objects(triggers, os.path.join(config_path, 'triggers'))
+    load_config_allowlist(allowlist, os.path.join(config_path, 'allowlist'))
 
 
 def load_config_filters(existing, config_path):
@@ -44,7 +111,27 @@ def load_config_filters(existing, config_path):
                             existing[params['log_path']].append(params)
 
 
+def load_config_allowlist(existing, config_path):
+    # The allowlist is optional, older installs will not have the directory
+    if not os.path.isdir(config_path):
+        return
+    allowlist_re = re.compile(r'^ *(?P<param>[^#|\s]+) *\| *(?P<value>[^#|\s]+)\s*(#.*)?$')
+    for allowlist_path in os.listdir(config_path):
+        if allowlist_path.endswith('.conf'):
+            allowlist_path = os.path.join(config_path, allowlist_path)
+            with open(allowlist_path) as allowlist_file:
+                for line in allowlist_file:
+                    match = allowlist_re.match(line)
+                    if match is not None:
+                        if match.group('param') not in existing:
+                            existing[match.group('param')] = [match.group('value')]
+                        else:
+                            existing[match.group('param')].append(match.group('value'))
+
+
 def load_config_objects(existing, config_path):
+    # Imported here as it isn't needed at all when the config cache is used
+    from configobj import ConfigObj
     if os.path.isfile(config_path):
         if config_path.endswith('.conf'):
             deep_merge_dict(existing, ConfigObj(config_path))
@@ -82,6 +82,8 @@ def initialize_db(db_args):
     DBBase.metadata.create_all(DBSession._db_engine)
     DBSession._open_new_session = sqlalchemy.orm.sessionmaker(bind=DBSession._db_engine)
     DBSession._main_thread_id = threading.get_ident()
+    # Timed events live in the database so there is nothing to check until it is open
+    main_loop.call_soon(_fire_timed_events)
 
 
 def hash_dict(value):
@@ -95,6 +97,27 @@ def hash_string(value):
     return base64.b64encode(key_hash.digest()).decode("utf-8")
 
 
+# (name, value) tuples -> hash_dict of the same params, most events come from a small set of repeat offenders
+_param_hash_cache = {}
+_PARAM_HASH_CACHE_SIZE = 100000
+
+
+def hash_params(params, names):
+    # Same result as hash_dict({name: params[name] for name in names}) without the json and sha256 on a cache hit
+    values = tuple((name, params[name]) for name in names)
+    try:
+        return _param_hash_cache[values]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable values can't be cached
+        return hash_dict(dict(values))
+    if len(_param_hash_cache) >= _PARAM_HASH_CACHE_SIZE:
+        _param_hash_cache.clear()
+    key = _param_hash_cache[values] = hash_dict(dict(values))
+    return key
+
+
 class DictionaryType(sqlalchemy.types.TypeDecorator):
 
     impl = sqlalchemy.Text
@@ -124,19 +147,47 @@ event_listeners = {}
 main_loop = asyncio.new_event_loop()
 main_loop_future = main_loop.create_future()
 
+# Events published but not yet fired
+pending_events = 0
+
+# Everything asks here for the current time so that replay can run on the time of the logs instead
+_clock = datetime.now
+
+
+def now():
+    return _clock()
 
-def run_main_loop():
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+
+def run_main_loop(reload_action=None):
     global _main_loop_thread_id
     _main_loop_thread_id = threading.get_ident()
     main_loop.add_signal_handler(signal.SIGINT, shutdown_main_loop)
     main_loop.add_signal_handler(signal.SIGTERM, shutdown_main_loop)
+    if reload_action is not None:
+        main_loop.add_signal_handler(signal.SIGHUP, reload_action)
     _logger.log(logging.NOTICE, "Monitoring...")
     main_loop.run_until_complete(main_loop_future)
+    # Give any background tasks (eg: network connections) the chance to clean up
+    pending = asyncio.all_tasks(main_loop)
+    if pending:
+        for task in pending:
+            task.cancel()
+        main_loop.run_until_complete(_wait_for_tasks(pending))
     _logger.log(logging.NOTICE, "Shutdown")
 
 
+async def _wait_for_tasks(tasks):
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def shutdown_main_loop():
-    main_loop_future.set_result(None)
+    if not main_loop_future.done():
+        main_loop_future.set_result(None)
 
 
 def register_action(event, action):
@@ -146,6 +197,30 @@ def register_action(event, action):
         event_listeners[event] = [action]
 
 
+def unregister_action(event, action):
+    try:
+        event_listeners[event].remove(action)
+    except (KeyError, ValueError):
+        pass
+
+
+class Event(object):
+
+    # Carried unchanged from the filter to every listener, params is shared so listeners must not modify it
+
+    __slots__ = ('name', 'params')
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+
+
+def event_action(action):
+    # Marks an action as taking the Event itself rather than action(event_name, **params)
+    action.takes_event = True
+    return action
+
+
 def publish_event(event, event_time=None, **params):
     if event_time is not None:
         _logger.debug("Scheduled event %s for %s: %s", event, event_time, params)
@@ -158,40 +233,63 @@ def publish_event(event, event_time=None, **params):
             )
             session.merge(event_object)
     else:
-        main_loop.call_soon(_fire_event, event, params)
+        publish(Event(event, params))
+
 
+def publish(event):
+    global pending_events
+    pending_events += 1
+    main_loop.call_soon(_dispatch_event, event)
 
-def _fire_event(event, params):
-    _logger.debug("Event %s: %s", event, params)
+
+def _dispatch_event(event):
+    global pending_events
+    pending_events -= 1
+    _fire_event(event)
+
+
+def _fire_event(event):
+    _logger.debug("Event %s: %s", event.name, event.params)
     try:
-        event_action_list = event_listeners[event]
-        for action in event_action_list:
-            try:
-                action(event, **params)
-            except:
-                _logger.exception("Failure with event %s", event)
+        event_action_list = event_listeners[event.name]
     except KeyError:
-        _logger.warning("Published event %s has no listeners, this warning will not be repeated", event)
-        event_listeners[event] = []
+        _logger.warning("Published event %s has no listeners, this warning will not be repeated", event.name)
+        event_listeners[event.name] = []
+        return
+    for action in event_action_list:
+        try:
+            if getattr(action, 'takes_event', False):
+                action(event)
+            else:
+                action(event.name, **event.params)
+        except:
+            _logger.exception("Failure with event %s", event.name)
 
 
 def _fire_timed_events():
     _logger.debug("Tick... checking timed events")
+    fire_timed_events(now())
+    main_loop.call_later(60, _fire_timed_events)
+
+
+def fire_timed_events(until):
     while True:
         with DBSession() as session:
-            event_details = session.query(_DBFutureEvent).filter(_DBFutureEvent.event_time <= datetime.now()).\
+            event_details = session.query(_DBFutureEvent).filter(_DBFutureEvent.event_time <= until).\
                 order_by(_DBFutureEvent.event_time).first()
             if event_details is None:
                 break
-            event = event_details.event
             params = event_details.params
             params['event_time'] = event_details.event_time
+            event = Event(event_details.event, params)
             session.delete(event_details)
-        _fire_event(event, params)
-    main_loop.call_later(60, _fire_timed_events)
+        _fire_event(event)
+
 
+def next_timed_event_time():
+    with DBSession() as session:
+        return session.query(sqlalchemy.func.min(_DBFutureEvent.event_time)).scalar()
 
-main_loop.call_later(0, _fire_timed_events)
 
 from sqlalchemy import Column, String, DateTime
 
@@ -4,7 +4,9 @@ import sqlalchemy
 import logging
 import threading
 
-from logban.core import DBBase, DBSession, main_loop, main_loop_future, hash_string
+import logban.core
+
+from logban.core import DBBase, DBSession, main_loop, main_loop_future, hash_string, deep_merge_dict
 
 from abc import ABC, abstractmethod
 
@@ -31,28 +33,27 @@ class FileMonitor(AbstractFileMonitor):
         self.file = None
         self.directory_monitor = _DirectoryMonitor.get_directory_monitor_for(file_path)
         self.directory_monitor.file_monitors[file_path] = self
-        with DBSession() as session:
-            status_entry = session.query(_DBLogStatus).get(hash_string(file_path))
-            if status_entry is None:
-                status_entry = _DBLogStatus(id=hash_string(file_path), path=file_path, position=0)
-                session.add(status_entry)
-                position = 0
-            else:
-                position = status_entry.position
-            self.status_entry = status_entry
-        self._open(position)
+        self._open(self._load_position())
 
     def shutdown(self):
         del self.directory_monitor.file_monitors[self.file_path]
+        read_scheduler.cancel(self)
         self._close()
         # Last one out turn off the lights
         if len(self.directory_monitor.file_monitors) == 0:
             self.directory_monitor.shutdown()
 
     def _read_new_lines(self):
+        # Reading is spread over several turns of the main loop alongside any other busy files
+        read_scheduler.schedule(self)
+
+    def _read_lines(self, max_lines, max_bytes):
+        # Returns True if it stopped on max_lines or max_bytes with more left to read
         if self.file is None:
-            return
+            return False
         pos = self.file.tell()
+        start_pos = pos
+        line_count = 0
         line = self.file.readline()
         if line == '':
             self.file.seek(0, os.SEEK_END)
@@ -61,6 +62,7 @@ class FileMonitor(AbstractFileMonitor):
                 _logger.info("Resetting %s to position 0", self.file_path)
                 self.file.seek(0, os.SEEK_SET)
                 pos = self.file.tell()
+                start_pos = pos
                 line = self.file.readline()
             elif pos > new_pos:
                 # file extended while checking
@@ -70,13 +72,39 @@ class FileMonitor(AbstractFileMonitor):
                 for line_filter in self.filters:
                     line_filter.filter_line(line=(line[:-1]))
                 pos = self.file.tell()
+                line_count += 1
+                if line_count >= max_lines or pos - start_pos >= max_bytes:
+                    self._save_position(pos)
+                    return True
                 line = self.file.readline()
             else:
                 # if we get a partial line we seek back to the start of the line
                 self.file.seek(pos, os.SEEK_SET)
                 line = ''
+        self._save_position(pos)
+        return False
+
+    def lag(self):
+        # Bytes not yet read
+        if self.file is None:
+            return 0
+        try:
+            return os.fstat(self.file.fileno()).st_size - self.file.tell()
+        except (OSError, ValueError):
+            return 0
+
+    def _load_position(self):
         with DBSession() as session:
-            self.status_entry.position = pos
+            status_entry = session.query(_DBLogStatus).get(hash_string(self.file_path))
+            if status_entry is None:
+                status_entry = _DBLogStatus(id=hash_string(self.file_path), path=self.file_path, position=0)
+                session.add(status_entry)
+            self.status_entry = status_entry
+            return status_entry.position
+
+    def _save_position(self, position):
+        with DBSession() as session:
+            self.status_entry.position = position
             session.merge(self.status_entry)
 
     def _open(self, position=0):
@@ -101,6 +129,75 @@ class FileMonitor(AbstractFileMonitor):
             self.file = None
 
 
+class _ReadScheduler(object):
+
+    # Files with new lines are read a slice at a time (at most lines_per_turn lines or bytes_per_turn bytes), going
+    # round every waiting file in order of how far behind it is and returning to the main loop after each slice.
+    # While more than high_water events are waiting to be fired nothing more is read.
+
+    def __init__(self):
+        self.lines_per_turn = 1000
+        self.bytes_per_turn = 1024 * 1024
+        self.high_water = 10000
+        self.throttle_delay = 0.05
+        # Monitors with lines waiting to be read, a dict to keep them in order
+        self.waiting = {}
+        self.turn = []
+        self.handle = None
+        self.throttled = False
+
+    def configure(self, config):
+        config_full = {
+            'lines_per_turn': '1000',
+            'bytes_per_turn': '1048576',
+            'high_water': '10000',
+            'throttle_delay': '0.05',
+        }
+        deep_merge_dict(config_full, config)
+        self.lines_per_turn = int(config_full['lines_per_turn'])
+        self.bytes_per_turn = int(config_full['bytes_per_turn'])
+        self.high_water = int(config_full['high_water'])
+        self.throttle_delay = float(config_full['throttle_delay'])
+
+    def schedule(self, file_monitor):
+        self.waiting[file_monitor] = None
+        self._wake()
+
+    def cancel(self, file_monitor):
+        self.waiting.pop(file_monitor, None)
+
+    def _wake(self):
+        if self.handle is None:
+            self.handle = main_loop.call_soon(self._run)
+
+    def _run(self):
+        self.handle = None
+        if logban.core.pending_events > self.high_water:
+            # Let the triggers catch up before reading any more
+            if not self.throttled:
+                _logger.info("Pausing log reading, %d events waiting", logban.core.pending_events)
+                self.throttled = True
+            self.handle = main_loop.call_later(self.throttle_delay, self._run)
+            return
+        if self.throttled:
+            _logger.info("Resuming log reading")
+            self.throttled = False
+        if not self.turn:
+            self.turn = sorted(self.waiting, key=lambda file_monitor: file_monitor.lag(), reverse=True)
+        while self.turn:
+            file_monitor = self.turn.pop(0)
+            if file_monitor in self.waiting:
+                del self.waiting[file_monitor]
+                if file_monitor._read_lines(self.lines_per_turn, self.bytes_per_turn):
+                    self.waiting[file_monitor] = None
+                break
+        if self.waiting:
+            self._wake()
+
+
+read_scheduler = _ReadScheduler()
+
+
 class _DirectoryMonitor(pyinotify.ProcessEvent):
 
     NOTIFY_EVENTS = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY
@@ -120,6 +217,7 @@ class _DirectoryMonitor(pyinotify.ProcessEvent):
 
     def shutdown(self):
         _DirectoryMonitor.watch_manager.del_watch(self.watch_handle)
+        _DirectoryMonitor.all_directory_monitors.pop(self.path, None)
 
     def process_IN_CREATE(self, event):
         if not event.dir and event.pathname in self.file_monitors:
@@ -1,10 +1,12 @@
 import re
 import logging
 import ipaddress
+import sys
 
 from datetime import datetime, timedelta
 
-from logban.core import publish_event
+from logban.cidr import CidrIndex
+from logban.core import Event, publish, now
 
 
 _logger = logging.getLogger(__name__)
@@ -13,32 +15,87 @@ _logger = logging.getLogger(__name__)
 class LogFilter(object):
 
     def __init__(self, event, log_path, pattern):
-        self.event = event
+        self.event = sys.intern(event)
         self.source_pattern = pattern
-        self.pattern = re.compile(pattern)
-        self.log_path = log_path
+        self.log_path = sys.intern(log_path)
         actual_pattern = pattern.format(**named_groups)
         _logger.debug("Pattern %s", pattern)
         _logger.debug("Becomes %s", actual_pattern)
         self.pattern = re.compile(actual_pattern)
 
     def filter_line(self, line):
+        params = self.parse_line(line)
+        if params is not None:
+            publish(self.make_event(params, line))
+
+    def make_event(self, params, line):
+        params['log_path'] = self.log_path
+        params['lines'] = [(self.log_path, params['time'], line)]
+        return Event(self.event, params)
+
+    def parse_line(self, line):
         found = self.pattern.search(line)
-        if found is not None:
-            _logger.debug("Matched log %s line: %s", self.log_path, line)
-            params = found.groupdict()
-            for processor in param_processors:
-                processor(params)
-            if 'time' not in params:
-                params['time'] = datetime.now()
-            publish_event(self.event, log_path=self.log_path,
-                          lines=[(self.log_path, params['time'], line)], **params)
+        if found is None:
+            return None
+        _logger.debug("Matched log %s line: %s", self.log_path, line)
+        params = found.groupdict()
+        for processor in param_processors:
+            processor(params)
+        if allowlist and allowlist.matches(params, found.groupdict()):
+            allowlist.dropped += 1
+            return None
+        if 'time' not in params:
+            params['time'] = now()
+        return params
+
+
+class Allowlist(object):
+
+    def __init__(self):
+        self.networks = {}
+        self.values = {}
+        self.dropped = 0
+
+    def __bool__(self):
+        return bool(self.networks or self.values)
+
+    def add(self, param, value):
+        try:
+            network = ipaddress.ip_network(value, strict=False)
+        except ValueError:
+            try:
+                self.values[param].add(value)
+            except KeyError:
+                self.values[param] = {value}
+        else:
+            try:
+                self.networks[param].add(network)
+            except KeyError:
+                self.networks[param] = CidrIndex()
+                self.networks[param].add(network)
+
+    def matches(self, params, raw_params):
+        for param, values in self.values.items():
+            if params.get(param) in values:
+                return True
+        for param, networks in self.networks.items():
+            # Addresses are matched as they appeared in the log, before IPv6 addresses are widened to their /64
+            value = raw_params.get(param)
+            if value is None:
+                value = params.get(param)
+            if value is not None:
+                try:
+                    if value in networks:
+                        return True
+                except ValueError:
+                    pass
+        return False
 
 
 def _process_syslog_time(params):
     if 'syslog_time' in params:
         log_time = datetime.strptime(params['syslog_time'], '%b %d %H:%M:%S')
-        today = datetime.now()
+        today = now()
         guess_year = log_time.replace(year=today.year)
         if guess_year > today + timedelta(days=1):
             guess_year = log_time.replace(year=today.year - 1)
@@ -79,6 +136,9 @@ named_groups = {
 }
 
 
+allowlist = Allowlist()
+
+
 param_processors = [
     _process_syslog_time,
     _process_ipaddress,
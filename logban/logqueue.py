@@ -0,0 +1,98 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+def start_queue_logging(handlers):
+    # Records are put on a queue by the caller and written out by a background thread so the main loop never
+    # waits on a slow disk or terminal
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # At exit rather than on main loop shutdown so that the last messages ("Shutdown") are written
+    atexit.register(listener.stop)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # The message is formatted before it is queued, the real handlers add the time, level etc.
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    return queue_handler
+
+
+class AggregatingFilter(logging.Filter):
+
+    # Once a message (by logger and format string) has been logged threshold times in a window, further copies in
+    # that window are counted instead and logged as one summary at the end of the window.  Only INFO and below are
+    # aggregated, anything more important is always logged.  Callers can pass extra={'aggregate_key': ...} to have
+    # the summary include the number of distinct keys (eg: hosts) the suppressed messages were for.
+
+    max_keys = 100000
+
+    def __init__(self, interval, threshold):
+        super().__init__()
+        self.interval = interval
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.window_end = time.monotonic() + interval
+        # (logger name, format string) -> _MessageCount
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or getattr(record, 'aggregate_summary', False):
+            return True
+        summaries = None
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.window_end:
+                summaries = self._end_window(now)
+            try:
+                count = self.counts[(record.name, record.msg)]
+            except KeyError:
+                count = self.counts[(record.name, record.msg)] = _MessageCount()
+            if count.logged < self.threshold:
+                count.logged += 1
+                result = True
+            else:
+                count.suppressed += 1
+                key = getattr(record, 'aggregate_key', None)
+                if key is not None and len(count.keys) < self.max_keys:
+                    count.keys.add(key)
+                result = False
+        if summaries:
+            self._log_summaries(summaries)
+        return result
+
+    def flush(self):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.window_end:
+                return
+            summaries = self._end_window(now)
+        self._log_summaries(summaries)
+
+    def _end_window(self, now):
+        summaries = [(name, msg, count) for (name, msg), count in self.counts.items() if count.suppressed]
+        self.counts = {}
+        self.window_end = now + self.interval
+        return summaries
+
+    def _log_summaries(self, summaries):
+        for name, msg, count in summaries:
+            keys = ""
+            if count.keys:
+                keys = " for %d%s keys" % (len(count.keys), '+' if len(count.keys) >= self.max_keys else '')
+            _logger.info("Suppressed %d more messages from %s%s in the last %ds like: %s", count.suppressed, name,
+                         keys, self.interval, msg, extra={'aggregate_summary': True})
+
+
+class _MessageCount(object):
+
+    __slots__ = ('logged', 'suppressed', 'keys')
+
+    def __init__(self):
+        self.logged = 0
+        self.suppressed = 0
+        self.keys = set()
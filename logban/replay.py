@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import logging
+import os.path
+import time as wall_time
+
+from collections import Counter
+from datetime import datetime
+
+import logban.config
+import logban.core
+import logban.filter
+import logban.startup
+import logban.trigger
+
+_logger = logging.getLogger(__name__)
+
+# Only a throwaway database is used, nothing a replay does is kept
+_REPLAY_DB = {'drivername': 'sqlite', 'database': ':memory:'}
+
+
+def replay_logs(log_args, output=None):
+    # Each argument is a log file, optionally followed by =<configured log path> when replaying a rotated or
+    # copied log through the filters configured for another path
+    replay = Replay()
+    for log_arg in log_args:
+        file_path, _, log_path = log_arg.partition('=')
+        replay.add_log(file_path, log_path or file_path)
+    replay.run()
+    replay.report(output)
+    return replay
+
+
+class Replay(object):
+
+    def __init__(self):
+        self.logs = []
+        # The virtual clock, the time of the line or timed event being handled
+        self.time = datetime.min
+        self.first_time = None
+        self.timeline = []
+        self.lines = 0
+        self.matched = Counter()
+        self.commands = 0
+        self.duration = None
+
+    def now(self):
+        return self.time
+
+    def add_log(self, file_path, log_path):
+        filter_conf = logban.config.filter_config.get(log_path)
+        if filter_conf is None:
+            raise ValueError("No filters are configured for %s" % log_path)
+        filters = [logban.filter.LogFilter(**config) for config in filter_conf]
+        self.logs.append((file_path, filters))
+
+    def run(self):
+        logban.core.set_clock(self.now)
+        logban.core.initialize_db(_REPLAY_DB)
+        logban.trigger.exec_command = self._exec_command
+        logban.trigger.ban_status_listeners.append(self._record)
+        # Snapshots would overwrite those of the running daemon
+        trigger_config = {trigger_id: {key: value for key, value in config.items() if key != 'snapshot_path'}
+                          for trigger_id, config in logban.config.trigger_config.items()}
+        logban.startup.configure_triggers(trigger_config)
+        start = wall_time.perf_counter()
+        logban.core.main_loop.run_until_complete(self._replay())
+        self.duration = wall_time.perf_counter() - start
+
+    async def _replay(self):
+        lines = [self._parse(index, file_path, filters) for index, (file_path, filters) in enumerate(self.logs)]
+        # Files are merged on the time of their lines so that events from different logs interleave as they happened
+        for line_time, _, _, _, line_filter, params, line in heapq.merge(*lines):
+            if self.first_time is None:
+                self.first_time = line_time
+            if line_time > self.time:
+                await self._advance(line_time)
+            self.matched[line_filter.event] += 1
+            logban.core.publish(line_filter.make_event(params, line))
+            await _drain()
+
+    def _parse(self, index, file_path, filters):
+        # Year guessing assumes lines are no newer than now so parse against the time the log was last written
+        file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
+        with open(file_path, errors='replace') as log_file:
+            for line_number, line in enumerate(log_file):
+                self.lines += 1
+                if line[-1:] == '\n':
+                    line = line[:-1]
+                replay_time, self.time = self.time, file_time
+                try:
+                    found = [(line_filter, line_filter.parse_line(line)) for line_filter in filters]
+                finally:
+                    self.time = replay_time
+                for filter_number, (line_filter, params) in enumerate(found):
+                    if params is not None:
+                        yield params['time'], index, line_number, filter_number, line_filter, params, line
+
+    async def _advance(self, until):
+        # Timed events (eg: the end of a ban) fire in order at their own time before the clock moves on
+        while True:
+            event_time = logban.core.next_timed_event_time()
+            if event_time is None or event_time > until:
+                break
+            self.time = event_time
+            logban.core.fire_timed_events(event_time)
+            await _drain()
+        self.time = until
+
+    def _exec_command(self, *args, **_):
+        self.commands += 1
+        _logger.debug("Replay skipped %s", ' '.join(args))
+        return 0
+
+    def _record(self, ban_trigger, status, scope, until):
+        self.timeline.append((self.time, ban_trigger.trigger_id, status, scope, until))
+
+    def report(self, output=None):
+        write = print if output is None else output
+        for decision_time, trigger_id, status, scope, until in self.timeline:
+            write("%s  %-20s %-10s %-40s until %s" % (decision_time, trigger_id, status, _format_scope(scope), until))
+        bans = [entry for entry in self.timeline if entry[2] == 'BAN']
+        banned = Counter((entry[1], _format_scope(entry[3])) for entry in bans)
+        write("")
+        write("Lines read:         %d" % self.lines)
+        for event, count in sorted(self.matched.items()):
+            write("  %-17s %d" % (event + ':', count))
+        write("Bans:               %d" % len(bans))
+        write("Distinct banned:    %d" % len(banned))
+        write("Banned repeatedly:  %d" % sum(1 for count in banned.values() if count > 1))
+        write("Banned at end:      %d" % sum(1 for ban_trigger in logban.trigger.ban_triggers.values()
+                                            for _ in ban_trigger.all_bans()))
+        if self.first_time is not None:
+            write("Log time covered:   %s to %s" % (self.first_time, self.time))
+        write("Ban commands:       %d (not run)" % self.commands)
+        if self.duration:
+            write("Replay took:        %.2fs (%.0f lines/s)" % (self.duration, self.lines / self.duration))
+
+
+async def _drain():
+    # Let every published event, and the events they publish in turn, fire before the next line
+    while logban.core.pending_events:
+        await asyncio.sleep(0)
+
+
+def _format_scope(scope):
+    return ' '.join("%s=%s" % item for item in sorted(scope.items()))
@@ -0,0 +1,309 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import socket
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+from logban.core import DBSession, main_loop, main_loop_future, deep_merge_dict, wrap_list, now
+from logban.trigger import ban_triggers, ban_status_listeners
+
+_logger = logging.getLogger(__name__)
+
+# Batches are single json lines and may be large
+_LINE_LIMIT = 16 * 1024 * 1024
+
+# Received decisions are applied this many at a time, yielding to the main loop in between
+_APPLY_SLICE = 20
+
+all_peers = []
+
+
+def initialize_replication(config):
+    config_full = {
+        'node_id': None,
+        'listen': None,
+        'peers': None,
+        'secret': None,
+        'batch_size': '500',
+        'batch_delay': '0.2',
+        'max_pending': '100000',
+        'retry_delay': '10',
+    }
+    deep_merge_dict(config_full, config)
+    listen = None if config_full['listen'] is None else _split_address(config_full['listen'])
+    node_id = config_full['node_id']
+    if node_id is None:
+        # Hostname alone is not unique when several nodes run on one host
+        node_id = socket.gethostname() if listen is None else "%s:%d" % (socket.gethostname(), listen[1])
+    node = ReplicationNode(node_id,
+                           config_full['secret'],
+                           int(config_full['batch_size']),
+                           float(config_full['batch_delay']),
+                           int(config_full['max_pending']),
+                           float(config_full['retry_delay']))
+    for peer in wrap_list(config_full['peers']):
+        node.add_peer(*_split_address(peer))
+    if listen is not None:
+        node.listen(*listen)
+    ban_status_listeners.append(node.publish)
+    main_loop_future.add_done_callback(lambda _: node.shutdown())
+    return node
+
+
+def _split_address(address):
+    host, _, port = address.strip().rpartition(':')
+    return host.strip('[]'), int(port)
+
+
+def _resolve(host):
+    try:
+        return {info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)}
+    except socket.gaierror:
+        _logger.warning("Could not resolve replication peer %s", host)
+        return set()
+
+
+def _unmap_address(address):
+    # IPv4 peers connecting to a dual stack listener appear as ::ffff:a.b.c.d
+    try:
+        mapped = ipaddress.ip_address(address).ipv4_mapped
+    except (ValueError, AttributeError):
+        return address
+    return address if mapped is None else str(mapped)
+
+
+class ReplicationNode(object):
+
+    def __init__(self, node_id, secret, batch_size, batch_delay, max_pending, retry_delay):
+        self.node_id = node_id
+        self.secret = None if secret is None else secret.encode('utf-8')
+        # Lets peers tell a restarted node from a replayed connection
+        self.epoch = int(time.time())
+        self.sequence = 0
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.peers = []
+        # Only connections from these addresses are accepted
+        self.peer_addresses = set()
+        # node_id -> (epoch, highest sequence applied) for the latest epoch seen from each node
+        self.applied = {}
+        self.server = None
+
+    def add_peer(self, host, port):
+        peer = _Peer(self, host, port)
+        self.peers.append(peer)
+        self.peer_addresses.update(_resolve(host))
+        all_peers.append(peer)
+        peer.task = main_loop.create_task(peer.run())
+
+    def listen(self, host, port):
+        main_loop.create_task(self._listen(host, port))
+
+    async def _listen(self, host, port):
+        try:
+            self.server = await asyncio.start_server(self._receive, host, port, limit=_LINE_LIMIT)
+        except OSError:
+            _logger.exception("Replication could not listen on %s:%d", host, port)
+            return
+        _logger.info("Replication %s listening on %s:%d", self.node_id, host, port)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.close()
+        for peer in self.peers:
+            peer.task.cancel()
+
+    def sign(self, body):
+        return hmac.new(self.secret, body, hashlib.sha256).hexdigest().encode('ascii')
+
+    def publish(self, ban_trigger, status, scope, until):
+        self.sequence += 1
+        decision = [self.sequence, ban_trigger.trigger_id, status, scope, until.timestamp()]
+        for peer in self.peers:
+            peer.queue(decision)
+
+    async def _receive(self, reader, writer):
+        peer_name = writer.get_extra_info('peername')
+        if _unmap_address(peer_name[0]) not in self.peer_addresses:
+            _logger.warning("Refusing replication connection from %s, not a configured peer", peer_name[0])
+            writer.close()
+            return
+        _logger.info("Replication connection from %s", peer_name)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    _logger.warning("Replication message from %s is too long, dropping connection", peer_name)
+                    break
+                if not line:
+                    break
+                message = self._decode(line, peer_name)
+                if message is not None:
+                    # The next line isn't read until this one is applied, so a busy node pushes back on its peers
+                    await self._apply(message)
+        except ConnectionError:
+            _logger.warning("Replication connection from %s failed", peer_name, exc_info=True)
+        except asyncio.CancelledError:
+            # Shutting down
+            pass
+        finally:
+            writer.close()
+
+    def _decode(self, line, peer_name):
+        try:
+            if self.secret is not None:
+                signature, _, line = line.partition(b' ')
+                if not hmac.compare_digest(signature, self.sign(line)):
+                    _logger.warning("Bad signature on replication message from %s", peer_name)
+                    return None
+            message = json.loads(line)
+            if not isinstance(message, dict) or not {'node', 'epoch', 'bans'} <= message.keys():
+                raise ValueError("Missing node, epoch or bans")
+            return message
+        except (ValueError, KeyError, TypeError):
+            _logger.warning("Invalid replication message from %s", peer_name, exc_info=True)
+            return None
+
+    async def _apply(self, message):
+        node_id = message['node']
+        if node_id == self.node_id:
+            _logger.warning("Ignoring replication message from self (%s), check node_id is unique", self.node_id)
+            return
+        epoch, last_applied = self.applied.get(node_id, (0, 0))
+        if message['epoch'] < epoch:
+            _logger.debug("Ignoring replication message from a previous run of %s", node_id)
+            return
+        if message['epoch'] > epoch:
+            epoch, last_applied = message['epoch'], 0
+        bans = message['bans']
+        applied = 0
+        for start in range(0, len(bans), _APPLY_SLICE):
+            # One transaction per slice
+            with DBSession():
+                for decision in bans[start:start + _APPLY_SLICE]:
+                    try:
+                        sequence, trigger_id, status, scope, until = decision
+                        if sequence <= last_applied:
+                            continue
+                        last_applied = sequence
+                        if self._apply_decision(trigger_id, status, scope, until):
+                            applied += 1
+                    except:
+                        _logger.exception("Failure applying replicated decision %s", decision)
+            self.applied[node_id] = (epoch, last_applied)
+            await asyncio.sleep(0)
+        _logger.info("Applied %d of %d replicated decisions from %s", applied, len(bans), node_id)
+
+    @staticmethod
+    def _apply_decision(trigger_id, status, scope, until):
+        ban_trigger = ban_triggers.get(trigger_id)
+        if ban_trigger is None:
+            _logger.debug("No ban trigger %s for replicated %s", trigger_id, scope)
+            return False
+        if not _valid_scope(ban_trigger, scope):
+            _logger.warning("Ignoring replicated %s with invalid scope %s", status, scope)
+            return False
+        time = now()
+        if status == 'BAN':
+            until = datetime.fromtimestamp(until)
+            return until > time and ban_trigger.remote_ban(scope, time, until)
+        if status == 'PROBATION':
+            return ban_trigger.remote_unban(scope, time)
+        return False
+
+
+def _valid_scope(ban_trigger, scope):
+    # Scope values end up on the command line of ban commands so only accept exactly what the trigger bans on
+    if not isinstance(scope, dict) or set(scope) != set(ban_trigger.ban_params):
+        return False
+    for key, value in scope.items():
+        if not isinstance(value, str):
+            return False
+        if key == 'rhost':
+            try:
+                ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                return False
+    return True
+
+
+class _Peer(object):
+
+    def __init__(self, node, host, port):
+        self.node = node
+        self.host = host
+        self.port = port
+        # Decisions waiting to be sent, a newer decision about the same ban replaces an older one
+        self.pending = OrderedDict()
+        self.pending_ready = asyncio.Event()
+        self.dropped = 0
+        self.task = None
+
+    def queue(self, decision):
+        key = (decision[1], json.dumps(decision[3], sort_keys=True))
+        self.pending.pop(key, None)
+        self.pending[key] = decision
+        if len(self.pending) > self.node.max_pending:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                _logger.warning("Replication to %s:%d is backed up, %d decisions dropped",
+                                self.host, self.port, self.dropped)
+        self.pending_ready.set()
+
+    async def run(self):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as error:
+                _logger.warning("Could not connect to replication peer %s:%d: %s", self.host, self.port, error)
+                await asyncio.sleep(self.node.retry_delay)
+                continue
+            _logger.info("Connected to replication peer %s:%d", self.host, self.port)
+            try:
+                await self._send_batches(writer)
+            except OSError as error:
+                _logger.warning("Lost replication peer %s:%d: %s", self.host, self.port, error)
+            finally:
+                writer.close()
+            await asyncio.sleep(self.node.retry_delay)
+
+    async def _send_batches(self, writer):
+        while True:
+            await self.pending_ready.wait()
+            # Give a burst a moment to build up into a single batch
+            await asyncio.sleep(self.node.batch_delay)
+            batch = {}
+            while self.pending and len(batch) < self.node.batch_size:
+                key, decision = self.pending.popitem(last=False)
+                batch[key] = decision
+            if not self.pending:
+                self.pending_ready.clear()
+            message = {'node': self.node.node_id, 'epoch': self.node.epoch, 'bans': list(batch.values())}
+            line = json.dumps(message, separators=(',', ':')).encode('utf-8')
+            if self.node.secret is not None:
+                line = self.node.sign(line) + b' ' + line
+            writer.write(line + b'\n')
+            try:
+                # Back-pressure: don't build another batch until the peer has taken this one
+                await writer.drain()
+            except OSError:
+                self._requeue(batch)
+                raise
+
+    def _requeue(self, batch):
+        # Put unsent decisions back at the front unless something newer has replaced them
+        for key, decision in reversed(list(batch.items())):
+            if key not in self.pending:
+                self.pending[key] = decision
+                self.pending.move_to_end(key, last=False)
+        self.pending_ready.set()
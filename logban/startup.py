@@ -1,3 +1,9 @@
+import time
+
+# Taken before anything heavy (sqlalchemy, pyinotify) is imported so import time shows in the startup timings
+_import_start = time.perf_counter()
+
+import contextlib
 import logging
 import logban
 import os.path
@@ -9,69 +15,235 @@ import logban.config
 import logban.core
 import logban.filemonitor
 import logban.filter
+import logban.logqueue
 import logban.plugins
 import logban.trigger
 
 _logger = logging.getLogger(__name__)
 
+# (phase, seconds) logged once the daemon has started
+startup_timings = [('imports', time.perf_counter() - _import_start)]
+
+# Workers are only imported when they are used
+running_worker_count = 0
+
+
+# trigger_id -> (config, [(event, action)]) so a reload can tell which triggers changed and unhook them
+configured_triggers = {}
+
 
 def main():
     options, actions = logban.config.parse_args(sys.argv[1:])
-    logban.config.load_config_files(**options)
-    for action in actions:
+    with _timed('config'):
+        logban.config.load_config_files(**options)
+    for index, action in enumerate(actions):
         if action == 'run':
             initialize_daemon()
-            logban.core.run_main_loop()
+            logban.core.run_main_loop(reload_action=reload_daemon)
         elif action == 'initdb':
             load_plugin_modules()
             logban.core.initialize_db(logban.config.core_config.get('db', {}))
+        elif action == 'replay':
+            # Everything after replay is a log file to replay
+            initialize_logging(level='WARNING')
+            load_plugin_modules()
+            initialize_allowlist()
+            from logban.replay import replay_logs
+            replay_logs(actions[index + 1:])
+            break
 
 
 def initialize_daemon():
+    global running_worker_count
 
     # Configure logging
-    initialize_logging(**logban.config.core_config.get('log', {}))
+    with _timed('logging'):
+        initialize_logging(**logban.config.core_config.get('log', {}))
 
     # Load plugins here so that logging has been setup, but all else can be modified by plugins
-    load_plugin_modules()
+    with _timed('plugins'):
+        load_plugin_modules()
 
     # Open database connection
-    logban.core.initialize_db(logban.config.core_config.get('db', {}))
+    with _timed('db'):
+        logban.core.initialize_db(logban.config.core_config.get('db', {}))
+
+    # Setup file monitors and filters, either here or spread across worker processes
+    logban.filemonitor.read_scheduler.configure(logban.config.core_config.get('reader', {}))
+    worker_count = _worker_count(logban.config.core_config)
+    if worker_count > 0:
+        with _timed('workers'):
+            from logban.workers import start_workers
+            start_workers(worker_count, logban.config.filter_config)
+            running_worker_count = worker_count
+    else:
+        with _timed('filters'):
+            initialize_allowlist()
+            configure_file_monitors(logban.config.filter_config)
+
+    # Setup triggers
+    with _timed('triggers'):
+        configure_triggers(logban.config.trigger_config)
+
+    # Share bans with other nodes
+    if 'replication' in logban.config.core_config:
+        with _timed('replication'):
+            from logban.replication import initialize_replication
+            initialize_replication(logban.config.core_config['replication'])
+
+    _logger.info("Started in %.0fms: %s", sum(seconds for _, seconds in startup_timings) * 1000,
+                 ', '.join("%s %.0fms" % (phase, seconds * 1000) for phase, seconds in startup_timings))
+
+
+@contextlib.contextmanager
+def _timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings.append((phase, time.perf_counter() - start))
+
+
+def reload_daemon():
+    _logger.log(logging.NOTICE, "Reloading configuration")
+    old_core_config = dict(logban.config.core_config)
+    old_filter_config = dict(logban.config.filter_config)
+    old_allowlist_config = dict(logban.config.allowlist_config)
+    try:
+        logban.config.reload_config_files()
+    except Exception:
+        _logger.exception("Could not reload configuration, keeping the current one")
+        return
+
+    # These are only read at startup
+    for section in ('log', 'db', 'workers', 'replication'):
+        if old_core_config.get(section) != logban.config.core_config.get(section):
+            _logger.warning("Changes to [%s] need a restart to take effect", section)
+
+    if running_worker_count > 0:
+        if (old_filter_config != logban.config.filter_config or
+                old_allowlist_config != logban.config.allowlist_config):
+            from logban.workers import restart_workers
+            restart_workers(running_worker_count, logban.config.filter_config)
+    else:
+        load_allowlist()
+        configure_file_monitors(logban.config.filter_config, reload=True)
+
+    configure_triggers(logban.config.trigger_config)
+    _logger.log(logging.NOTICE, "Reloaded configuration")
 
-    # Setup file monitors and filters
-    for file_path, filter_conf in logban.config.filter_config.items():
-        file_path = os.path.realpath(file_path)
+
+def configure_file_monitors(filter_config, reload=False):
+    wanted = {}
+    for log_path, filter_conf in filter_config.items():
+        wanted.setdefault(os.path.realpath(log_path), []).extend(filter_conf)
+
+    for file_path in list(logban.filemonitor.all_file_monitors):
+        if file_path not in wanted:
+            _logger.info("No longer monitoring %s", file_path)
+            logban.filemonitor.all_file_monitors.pop(file_path).shutdown()
+
+    for file_path, filter_conf in wanted.items():
         try:
             file_monitor = logban.filemonitor.all_file_monitors[file_path]
         except KeyError:
             file_monitor = logban.filemonitor.FileMonitor(file_path)
             logban.filemonitor.all_file_monitors[file_path] = file_monitor
-        for config in filter_conf:
-            new_filter = logban.filter.LogFilter(**config)
-            file_monitor.filters.append(new_filter)
+            if reload:
+                # At startup the directory monitor loop does the first read
+                logban.core.main_loop.call_soon(file_monitor._read_new_lines)
+        # Keep the compiled filters which haven't changed
+        existing = {(line_filter.event, line_filter.source_pattern): line_filter
+                    for line_filter in file_monitor.filters}
+        file_monitor.filters[:] = [existing.get((config['event'], config['pattern'])) or
+                                   logban.filter.LogFilter(**config)
+                                   for config in filter_conf]
+
+
+def configure_triggers(trigger_config):
+    for trigger_id, (config, _) in list(configured_triggers.items()):
+        if trigger_config.get(trigger_id) != config:
+            _remove_trigger(trigger_id)
+    for trigger_id, config in trigger_config.items():
+        if trigger_id not in configured_triggers:
+            _add_trigger(trigger_id, config)
+
+
+def _add_trigger(trigger_id, config):
+    builder = logban.trigger.trigger_types[config['type']]
+    builder_config = config.copy()
+    del builder_config['type']
+    # Builders register their own actions, find them by comparing the listeners before and after
+    before = {event: set(map(id, actions)) for event, actions in logban.core.event_listeners.items()}
+    builder(trigger_id, builder_config)
+    actions = [(event, action)
+               for event, event_actions in logban.core.event_listeners.items()
+               for action in event_actions
+               if id(action) not in before.get(event, ())]
+    configured_triggers[trigger_id] = (config, actions)
+
+
+def _remove_trigger(trigger_id):
+    _, actions = configured_triggers.pop(trigger_id)
+    _logger.info("Removing trigger %s", trigger_id)
+    owners = []
+    for event, action in actions:
+        logban.core.unregister_action(event, action)
+        owner = getattr(action, '__self__', None)
+        if owner is not None and owner not in owners:
+            owners.append(owner)
+    for owner in owners:
+        if hasattr(owner, 'shutdown'):
+            owner.shutdown()
+        if logban.trigger.ban_triggers.get(trigger_id) is owner:
+            del logban.trigger.ban_triggers[trigger_id]
 
-    # Setup triggers
-    for trigger_id, config in logban.config.trigger_config.items():
-        builder = logban.trigger.trigger_types[config['type']]
-        config = config.copy()
-        del config['type']
-        builder(trigger_id, config)
+
+def _worker_count(core_config):
+    return int(core_config.get('workers', {}).get('count', '0'))
+
+
+def initialize_allowlist():
+    load_allowlist()
+    logban.core.main_loop_future.add_done_callback(_log_allowlist_dropped)
+
+
+def load_allowlist():
+    # Built aside and swapped in so a reload never leaves a half filled allowlist in use
+    new_allowlist = logban.filter.Allowlist()
+    for param, values in logban.config.allowlist_config.items():
+        for value in values:
+            new_allowlist.add(param, value)
+    new_allowlist.dropped = logban.filter.allowlist.dropped
+    logban.filter.allowlist = new_allowlist
+
+
+def _log_allowlist_dropped(_):
+    if logban.filter.allowlist or logban.filter.allowlist.dropped:
+        _logger.info("Allowlist dropped %d events", logban.filter.allowlist.dropped)
 
 
 def initialize_logging(level='INFO', log_path=None, date_format='%Y-%m-%d %H:%M:%S',
-                       fine_grained_level=None):
+                       fine_grained_level=None, aggregate_interval='10', aggregate_threshold='20'):
     logging.NOTICE = logging.ERROR + 5
     logging._levelToName[logging.NOTICE] = 'NOTICE'
     logging._nameToLevel['NOTICE'] = logging.NOTICE
     line_format = "%(asctime)s %(name)s [%(levelname)-7.7s]  %(message)s"
-    handlers = []
     if log_path is not None:
-        handlers.append(logging.FileHandler(filename=log_path))
+        handler = logging.FileHandler(filename=log_path)
     else:
-        handlers.append(logging.StreamHandler(stream=sys.stdout))
+        handler = logging.StreamHandler(stream=sys.stdout)
+    handler.setFormatter(logging.Formatter(line_format, datefmt=date_format))
+    queue_handler = logban.logqueue.start_queue_logging([handler])
+
+    # Repetitive messages (eg: a strike for every failed login during an attack) are summarised
+    aggregate_interval = int(aggregate_interval)
+    if aggregate_interval > 0:
+        aggregating_filter = logban.logqueue.AggregatingFilter(aggregate_interval, int(aggregate_threshold))
+        queue_handler.addFilter(aggregating_filter)
+        _schedule_log_flush(aggregating_filter)
 
-    logging.basicConfig(level=logging._nameToLevel[level], format=line_format,
-                        handlers=handlers, datefmt=date_format)
+    logging.basicConfig(level=logging._nameToLevel[level], handlers=[queue_handler])
 
     if fine_grained_level is not None:
         for key, value in fine_grained_level.items():
@@ -80,6 +252,11 @@ def initialize_logging(level='INFO', log_path=None, date_format='%Y-%m-%d %H:%M:
     _logger.log(logging.NOTICE, "Logging Started")
 
 
+def _schedule_log_flush(aggregating_filter):
+    aggregating_filter.flush()
+    logban.core.main_loop.call_later(aggregating_filter.interval, _schedule_log_flush, aggregating_filter)
+
+
 def load_plugin_modules(package=logban.plugins):
     for finder, module_name, is_package in pkgutil.iter_modules(package.__path__):
         module_name = "%s.%s" % (package.__name__, module_name)
@@ -1,16 +1,42 @@
+import ipaddress
 import json
+import os
 import subprocess
 import logging
 import re
 
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import timedelta
 
-from logban.core import register_action, publish_event, DBBase, DBSession, wrap_list, deep_merge_dict, hash_dict
+from logban.cidr import CidrIndex
+from logban.core import register_action, event_action, publish_event, DBBase, DBSession, wrap_list, deep_merge_dict, \
+    hash_params, main_loop, main_loop_future
 
 
 _logger = logging.getLogger(__name__)
 
+ban_triggers = {}
+
+# Called as listener(ban_trigger, status, scope, until) after a trigger bans ('BAN') or unbans ('PROBATION')
+ban_status_listeners = []
+
+
+def is_banned(address, trigger_id=None):
+    if trigger_id is not None:
+        return ban_triggers[trigger_id].is_banned(address)
+    for ban_trigger in ban_triggers.values():
+        if ban_trigger.is_banned(address):
+            return True
+    return False
+
+
+def _scope_network(scope):
+    try:
+        return ipaddress.ip_network(scope['rhost'], strict=False)
+    except (KeyError, ValueError):
+        return None
+
 
 def _decode_trigger_key(key):
     return json.loads(key)
@@ -58,9 +84,15 @@ class GroupCounterTrigger(object):
         self.count = int(count)
         self.timeout = timedelta(seconds=int(timeout))
 
-    def trigger(self, event, time, lines, **params):
+    @event_action
+    def trigger(self, event):
+        params = event.params
+        if 'rhost' in params and is_banned(params['rhost']):
+            _logger.debug("%s: Ignoring %s from banned %s", self.trigger_id, event.name, params['rhost'])
+            return
+        time = params['time']
         relevant_params = {key: params[key] for key in self.group_on}
-        key = hash_dict((relevant_params))
+        key = hash_params(params, self.group_on)
         with DBSession() as session:
             status = session.query(_DBTriggerStatus).filter_by(trigger_id=self.trigger_id, status_key=key).one_or_none()
             if status is None:
@@ -85,30 +117,166 @@ class GroupCounterTrigger(object):
                     # Times come out in order so stop on the first
                     break
             _logger.info("%s: Strike %d of %d for %s caused by %s", self.trigger_id,
-                         status.trigger_count, self.count, relevant_params, event)
+                         status.trigger_count, self.count, relevant_params, event.name, extra={'aggregate_key': key})
             if status.trigger_count >= self.count:
                 publish_event(
                     self.result_event,
-                    lines=[(line.log, line.time, line.line) for line in status.lines]+lines,
+                    lines=[(line.log, line.time, line.line) for line in status.lines]+params['lines'],
                     time=time,
                     **relevant_params
                 )
                 session.delete(status)
             else:
                 status.times.append(_DBTriggerStatusTime(time=time))
-                for log, line_time, line in lines:
+                for log, line_time, line in params['lines']:
                     status.lines.append(_DBTriggerStatusLine(log=log, time=line_time, line=line))
 
-    def reset(self, _, **params):
-        relevant_params = {key: params[key] for key in self.group_on}
-        _logger.debug("%s: reset to 0 %s", self.trigger_id, relevant_params)
+    @event_action
+    def reset(self, event):
+        _logger.debug("%s: reset to 0 %s", self.trigger_id, {key: event.params[key] for key in self.group_on})
         with DBSession() as session:
             session.query(_DBTriggerStatus).filter_by(
                 trigger_id=self.trigger_id,
-                status_key=hash_dict(relevant_params)
+                status_key=hash_params(event.params, self.group_on)
             ).delete()
 
 
+class RateTrigger(object):
+
+    @staticmethod
+    def configure(trigger_id, config):
+        config_full = {
+            'group_on': None,
+            'trigger_events': None,
+            'reset_events': None,
+            'count': '100',
+            'period': '60',
+            'max_keys': '200000',
+            'snapshot_path': None,
+            'snapshot_interval': '300',
+        }
+        deep_merge_dict(config_full, config)
+        new_trigger = RateTrigger(trigger_id,
+                                  wrap_list(config_full['group_on']),
+                                  config_full['result_event'],
+                                  config_full['count'],
+                                  config_full['period'],
+                                  config_full['max_keys'])
+        for event in wrap_list(config_full['trigger_events']):
+            register_action(event, new_trigger.trigger)
+        for event in wrap_list(config_full['reset_events']):
+            register_action(event, new_trigger.reset)
+        if config_full['snapshot_path'] is not None:
+            new_trigger.enable_snapshots(config_full['snapshot_path'], int(config_full['snapshot_interval']))
+
+    def __init__(self, trigger_id, group_on, result_event, count, period, max_keys):
+        self.group_on = wrap_list(group_on)
+        self.trigger_id = trigger_id
+        self.result_event = result_event
+        self.count = int(count)
+        self.period = int(period)
+        if self.count < 1 or self.period < 1:
+            raise ValueError("%s: count and period must both be at least 1, got count=%s period=%s"
+                             % (trigger_id, count, period))
+        self.rate = self.count / self.period
+        self.max_keys = int(max_keys)
+        self.snapshot_path = None
+        # Least recently updated first so idle keys can be evicted from the front
+        self.buckets = OrderedDict()
+
+    @event_action
+    def trigger(self, event):
+        params = event.params
+        key = tuple(params[name] for name in self.group_on)
+        time = params['time']
+        now = time.timestamp()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = _RateBucket(self.count, now)
+            self.buckets[key] = bucket
+        else:
+            self.buckets.move_to_end(key)
+            if now > bucket.last_time:
+                bucket.tokens = min(self.count, bucket.tokens + (now - bucket.last_time) * self.rate)
+                bucket.last_time = now
+        if bucket.tokens < 1:
+            relevant_params = dict(zip(self.group_on, key))
+            _logger.info("%s: Rate of %d per %ds exceeded for %s caused by %s", self.trigger_id,
+                         self.count, self.period, relevant_params, event.name, extra={'aggregate_key': key})
+            del self.buckets[key]
+            publish_event(self.result_event, lines=params['lines'], time=time, **relevant_params)
+        else:
+            bucket.tokens -= 1
+        self._evict(now)
+
+    @event_action
+    def reset(self, event):
+        key = tuple(event.params[name] for name in self.group_on)
+        _logger.debug("%s: reset %s", self.trigger_id, key)
+        self.buckets.pop(key, None)
+
+    def _evict(self, now):
+        # A bucket idle for a whole period has refilled so forgetting it loses nothing
+        idle_time = now - self.period
+        buckets = self.buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if bucket.last_time >= idle_time and len(buckets) <= self.max_keys:
+                break
+            del buckets[key]
+
+    def enable_snapshots(self, snapshot_path, snapshot_interval):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._load_snapshot()
+        self.snapshot_handle = main_loop.call_later(self.snapshot_interval, self._periodic_snapshot)
+        main_loop_future.add_done_callback(lambda _: self._save_snapshot())
+
+    def shutdown(self):
+        # Called when the trigger is removed or rebuilt by a reload, hand the state over through the snapshot
+        if self.snapshot_path is not None:
+            self.snapshot_handle.cancel()
+            self._save_snapshot()
+            self.snapshot_path = None
+
+    def _periodic_snapshot(self):
+        self._save_snapshot()
+        self.snapshot_handle = main_loop.call_later(self.snapshot_interval, self._periodic_snapshot)
+
+    def _save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        try:
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'w') as snapshot_file:
+                json.dump([[list(key), bucket.tokens, bucket.last_time] for key, bucket in self.buckets.items()],
+                          snapshot_file)
+            os.replace(temp_path, self.snapshot_path)
+            _logger.debug("%s: Saved %d keys to %s", self.trigger_id, len(self.buckets), self.snapshot_path)
+        except OSError:
+            _logger.exception("%s: Could not save snapshot %s", self.trigger_id, self.snapshot_path)
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                for key, tokens, last_time in json.load(snapshot_file):
+                    self.buckets[tuple(key)] = _RateBucket(tokens, last_time)
+            _logger.info("%s: Loaded %d keys from %s", self.trigger_id, len(self.buckets), self.snapshot_path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            _logger.exception("%s: Could not load snapshot %s", self.trigger_id, self.snapshot_path)
+
+
+class _RateBucket(object):
+
+    __slots__ = ('tokens', 'last_time')
+
+    def __init__(self, tokens, last_time):
+        self.tokens = tokens
+        self.last_time = last_time
+
+
 class AbstractBanTrigger(ABC):
 
     def __init__(self, trigger_id, ban_time, probation_time, repeat_scale, ban_params):
@@ -118,20 +286,109 @@ class AbstractBanTrigger(ABC):
         self.repeat_scale = int(repeat_scale)
         self.ban_params = ban_params
         self.time_event = ".timer." + self.trigger_id
+        # In memory copy of every BAN and PROBATION in the database for this trigger: status_key -> (status, scope)
+        self._statuses = {}
+        # Every banned or probationary rhost: network -> set of status_key
+        self._address_index = CidrIndex()
+        self._load_statuses()
+        ban_triggers[trigger_id] = self
+
+    def _load_statuses(self):
+        with DBSession() as session:
+            for status in session.query(_DBTriggerStatus).filter(
+                    _DBTriggerStatus.trigger_id == self.trigger_id,
+                    _DBTriggerStatus.status.in_(('BAN', 'PROBATION'))):
+                self._set_status(status.status_key, status.status_scope, status.status)
+
+    def _set_status(self, key, scope, status):
+        self._clear_status(key)
+        self._statuses[key] = (status, scope)
+        network = _scope_network(scope)
+        if network is not None:
+            keys = self._address_index.get(network)
+            if keys is None:
+                self._address_index.add(network, {key})
+            else:
+                keys.add(key)
+
+    def _clear_status(self, key):
+        try:
+            _, scope = self._statuses.pop(key)
+        except KeyError:
+            return
+        network = _scope_network(scope)
+        if network is not None:
+            keys = self._address_index.get(network)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    self._address_index.discard(network)
 
     def all_bans(self):
+        for status, scope in list(self._statuses.values()):
+            if status == 'BAN':
+                yield scope
+
+    def ban_status(self, address):
+        # Returns 'BAN' or 'PROBATION' for the strictest status of any ban containing the address, otherwise None
+        # Anything which is not an IP address or network is never banned
+        result = None
+        try:
+            matches = list(self._address_index.matches(address))
+        except ValueError:
+            return None
+        for keys in matches:
+            for key in keys:
+                status = self._statuses[key][0]
+                if status == 'BAN':
+                    return status
+                result = status
+        return result
+
+    def is_banned(self, address):
+        return self.ban_status(address) == 'BAN'
+
+    @event_action
+    def trigger(self, event):
+        params = event.params
+        relevant_params = {key: params[key] for key in self.ban_params}
+        key = hash_params(params, self.ban_params)
+        current = self._statuses.get(key)
+        if current is not None and current[0] == 'BAN':
+            _logger.debug("%s: Skipping duplicate ban: %s", self.trigger_id, relevant_params)
+            return
+        probation_time = self._apply_ban(key, relevant_params, params['time'], params['lines'])
+        self._notify('BAN', relevant_params, probation_time)
+
+    def remote_ban(self, scope, time, probation_time):
+        # Apply a ban decided elsewhere (eg: by another node), listeners are not notified to avoid loops
+        relevant_params = {key: scope[key] for key in self.ban_params}
+        key = hash_params(scope, self.ban_params)
+        current = self._statuses.get(key)
+        if current is not None and current[0] == 'BAN':
+            return False
+        self._apply_ban(key, relevant_params, time, [], probation_time)
+        return True
+
+    def remote_unban(self, scope, time):
+        relevant_params = {key: scope[key] for key in self.ban_params}
+        key = hash_params(scope, self.ban_params)
+        current = self._statuses.get(key)
+        if current is None or current[0] != 'BAN':
+            return False
         with DBSession() as session:
-            for ban in session.query(_DBTriggerStatus).filter_by(trigger_id=self.trigger_id):
-                if ban.status == 'BAN':
-                    yield ban.status_scope
+            status = session.query(_DBTriggerStatus).filter_by(trigger_id=self.trigger_id, status_key=key).one_or_none()
+            if status is None:
+                self._clear_status(key)
+                return False
+            self._apply_probation(status, key, time)
+        self._set_status(key, relevant_params, 'PROBATION')
+        return True
 
-    def trigger(self, _, time, lines, **params):
-        relevant_params = {key: params[key] for key in self.ban_params}
-        key = hash_dict(relevant_params)
+    def _apply_ban(self, key, relevant_params, time, lines, probation_time=None):
         with DBSession() as session:
             status = session.query(_DBTriggerStatus).filter_by(trigger_id=self.trigger_id, status_key=key).one_or_none()
             if status is None:
-                ban_now = True
                 status = _DBTriggerStatus(
                     trigger_id=self.trigger_id,
                     status_key=key,
@@ -140,37 +397,53 @@ class AbstractBanTrigger(ABC):
                     first_time=time
                 )
                 session.add(status)
-            else:
-                ban_now = status.status != 'BAN'
-                status.last_time = time
-                status.trigger_count += 1
             for log, line_time, line in lines:
                 status.lines.append(_DBTriggerStatusLine(log=log, time=line_time, line=line))
-            if ban_now:
-                status.status = 'BAN'
-                status.last_time = time
-                status.trigger_count += 1
-                status.times.append(_DBTriggerStatusTime(time=time))
-                _logger.log(logging.NOTICE, "%s: Banning %s", self.trigger_id, relevant_params)
-                self._ban(**relevant_params)
+            status.status = 'BAN'
+            status.last_time = time
+            status.trigger_count += 1
+            status.times.append(_DBTriggerStatusTime(time=time))
+            _logger.log(logging.NOTICE, "%s: Banning %s", self.trigger_id, relevant_params)
+            self._ban(**relevant_params)
+            if probation_time is None:
                 probation_time = time + (self.ban_time * (self.repeat_scale ** (status.trigger_count - 1)))
-                publish_event(self.time_event, event_time=probation_time, key=key)
-            else:
-                _logger.debug("%s: Skipping duplicate ban: %s", self.trigger_id, relevant_params)
+            publish_event(self.time_event, event_time=probation_time, key=key)
+        self._set_status(key, relevant_params, 'BAN')
+        return probation_time
+
+    def _apply_probation(self, status, key, time):
+        _logger.log(logging.NOTICE, "%s: Probation %s", self.trigger_id, status.status_scope)
+        self._unban(**status.status_scope)
+        status.status = 'PROBATION'
+        publish_event(self.time_event, event_time=time + self.probation_time, key=key)
+
+    def _notify(self, status, scope, until):
+        for listener in ban_status_listeners:
+            try:
+                listener(self, status, scope, until)
+            except:
+                _logger.exception("%s: Failure notifying %s of %s", self.trigger_id, status, scope)
 
     def timer_action(self, event, event_time, key):
         with DBSession() as session:
             status = session.query(_DBTriggerStatus).filter_by(trigger_id=self.trigger_id, status_key=key).one_or_none()
             if status is None:
+                self._clear_status(key)
                 return
+            scope = status.status_scope
+            new_status = status.status
             if status.status == 'BAN':
-                _logger.log(logging.NOTICE, "%s: Probation %s", self.trigger_id, status.status_scope)
-                self._unban(**status.status_scope)
-                status.status = 'PROBATION'
-                publish_event(event, event_time=event_time + self.probation_time, key=key)
+                self._apply_probation(status, key, event_time)
+                new_status = status.status
             elif status.status == 'PROBATION':
-                _logger.log(logging.NOTICE, "%s: Clear %s", self.trigger_id, status.status_scope)
+                _logger.log(logging.NOTICE, "%s: Clear %s", self.trigger_id, scope)
                 session.delete(status)
+                new_status = None
+        if new_status is None:
+            self._clear_status(key)
+        else:
+            self._set_status(key, scope, new_status)
+            self._notify(new_status, scope, event_time + self.probation_time)
 
     @abstractmethod
     def _ban(self, **params):
@@ -287,5 +560,6 @@ class _DBTriggerStatusLine(DBBase):
 
 trigger_types = {
     'group_counter': GroupCounterTrigger.configure,
+    'rate': RateTrigger.configure,
     'ip_ban': IptablesBanTrigger.configure,
 }
@@ -0,0 +1,228 @@
+import logging
+import multiprocessing
+import os.path
+import signal
+
+import logban.config
+import logban.core
+import logban.filemonitor
+import logban.filter
+
+from logban.core import DBSession, Event, main_loop, main_loop_future, publish, register_action, event_action, \
+    hash_string
+from logban.filemonitor import FileMonitor, _DBLogStatus
+
+_logger = logging.getLogger(__name__)
+
+# Set to the worker number inside a worker process, None in the main process
+current_worker = None
+
+all_workers = []
+
+# Events are sent to the main process once this many are waiting or this many seconds after the first
+BATCH_SIZE = 500
+BATCH_DELAY = 0.05
+
+# Delay before restarting a worker which died, to avoid spinning on a worker which can't start
+RESTART_DELAY = 5
+
+_context = multiprocessing.get_context('spawn')
+
+
+def start_workers(worker_count, filter_config):
+    _start_shards(worker_count, filter_config)
+    main_loop_future.add_done_callback(lambda _: stop_workers())
+
+
+def restart_workers(worker_count, filter_config):
+    # Workers resume from their last checkpoint so nothing is lost by restarting them
+    stop_workers()
+    del all_workers[:]
+    _start_shards(worker_count, filter_config)
+
+
+def _start_shards(worker_count, filter_config):
+    log_paths = sorted(filter_config)
+    for worker_id in range(worker_count):
+        shard = log_paths[worker_id::worker_count]
+        if shard:
+            worker = WorkerProcess(worker_id, shard)
+            all_workers.append(worker)
+            worker.start()
+
+
+def stop_workers():
+    for worker in all_workers:
+        worker.stop()
+
+
+class WorkerProcess(object):
+
+    def __init__(self, worker_id, log_paths):
+        self.worker_id = worker_id
+        self.log_paths = log_paths
+        self.process = None
+        self.connection = None
+
+    def start(self):
+        if main_loop_future.done():
+            return
+        positions = self._load_positions()
+        receive_connection, send_connection = _context.Pipe(duplex=False)
+        self.process = _context.Process(
+            target=_worker_main,
+            name="logban-worker-%d" % self.worker_id,
+            args=(self.worker_id, self.log_paths, positions, logban.config.loaded_config_path, send_connection),
+            daemon=True,
+        )
+        self.process.start()
+        send_connection.close()
+        self.connection = receive_connection
+        main_loop.add_reader(self.connection.fileno(), self._receive)
+        _logger.info("Started worker %d (pid %d) for %s", self.worker_id, self.process.pid, ', '.join(self.log_paths))
+
+    def stop(self):
+        # Let the worker flush before closing our end of the pipe.  Anything it sends now is not
+        # checkpointed so will be read again from the last checkpoint on the next start.
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(5)
+            self.process = None
+        self._close_connection()
+
+    def _receive(self):
+        try:
+            events, positions = self.connection.recv()
+        except (EOFError, OSError):
+            self._died()
+            return
+        for event, params in events:
+            publish(Event(event, params))
+        if positions:
+            # Queued behind the events so the checkpoint is only written once they have been handled
+            main_loop.call_soon(self._save_positions, positions)
+        if logban.core.pending_events > logban.filemonitor.read_scheduler.high_water:
+            # Stop taking batches so the worker blocks sending and stops reading until the triggers catch up
+            main_loop.remove_reader(self.connection.fileno())
+            main_loop.call_later(logban.filemonitor.read_scheduler.throttle_delay, self._resume)
+
+    def _resume(self):
+        if self.connection is None:
+            return
+        if logban.core.pending_events > logban.filemonitor.read_scheduler.high_water:
+            main_loop.call_later(logban.filemonitor.read_scheduler.throttle_delay, self._resume)
+        else:
+            main_loop.add_reader(self.connection.fileno(), self._receive)
+
+    def _died(self):
+        self._close_connection()
+        self.process.join(1)
+        if main_loop_future.done():
+            return
+        _logger.error("Worker %d exited with code %s, restarting in %ds",
+                      self.worker_id, self.process.exitcode, RESTART_DELAY)
+        self.process = None
+        main_loop.call_later(RESTART_DELAY, self.start)
+
+    def _close_connection(self):
+        if self.connection is not None:
+            main_loop.remove_reader(self.connection.fileno())
+            self.connection.close()
+            self.connection = None
+
+    def _load_positions(self):
+        positions = {}
+        with DBSession() as session:
+            for log_path in self.log_paths:
+                file_path = os.path.realpath(log_path)
+                status_entry = session.query(_DBLogStatus).get(hash_string(file_path))
+                positions[file_path] = 0 if status_entry is None else status_entry.position
+        return positions
+
+    @staticmethod
+    def _save_positions(positions):
+        with DBSession() as session:
+            for file_path, position in positions.items():
+                session.merge(_DBLogStatus(id=hash_string(file_path), path=file_path, position=position))
+
+
+class WorkerFileMonitor(FileMonitor):
+
+    def __init__(self, file_path, position, batcher):
+        self.initial_position = position
+        self.batcher = batcher
+        super().__init__(file_path)
+
+    def _load_position(self):
+        return self.initial_position
+
+    def _save_position(self, position):
+        # Queued behind the events published while reading so they are sent first
+        main_loop.call_soon(self.batcher.add_position, self.file_path, position)
+
+
+class _EventBatcher(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.events = []
+        self.positions = {}
+        self.flush_handle = None
+
+    @event_action
+    def add_event(self, event):
+        self.events.append((event.name, event.params))
+        if len(self.events) >= BATCH_SIZE:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = main_loop.call_later(BATCH_DELAY, self.flush)
+
+    def add_position(self, file_path, position):
+        self.positions[file_path] = position
+        if self.flush_handle is None:
+            self.flush_handle = main_loop.call_later(BATCH_DELAY, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.events or self.positions:
+            try:
+                self.connection.send((self.events, self.positions))
+            except OSError:
+                # The main process has gone, nothing was checkpointed so nothing is lost
+                _logger.warning("Could not send %d events to the main process", len(self.events))
+            self.events = []
+            self.positions = {}
+
+
+def _worker_main(worker_id, log_paths, positions, config_path, connection):
+    global current_worker
+    import logban.startup
+    current_worker = worker_id
+    logban.config.load_config_files(config_path)
+    logban.startup.initialize_logging(**logban.config.core_config.get('log', {}))
+    logban.startup.load_plugin_modules()
+    logban.startup.initialize_allowlist()
+
+    logban.filemonitor.read_scheduler.configure(logban.config.core_config.get('reader', {}))
+    batcher = _EventBatcher(connection)
+    events = set()
+    for log_path in log_paths:
+        file_path = os.path.realpath(log_path)
+        file_monitor = WorkerFileMonitor(file_path, positions.get(file_path, 0), batcher)
+        logban.filemonitor.all_file_monitors[file_path] = file_monitor
+        for config in logban.config.filter_config[log_path]:
+            new_filter = logban.filter.LogFilter(**config)
+            file_monitor.filters.append(new_filter)
+            events.add(new_filter.event)
+    for event in events:
+        register_action(event, batcher.add_event)
+
+    # Reloads are handled by the main process restarting workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Send everything outstanding on the way out and stop if the main process goes away
+    main_loop_future.add_done_callback(lambda _: batcher.flush())
+    main_loop.add_reader(multiprocessing.parent_process().sentinel, logban.core.shutdown_main_loop)
+    logban.core.run_main_loop()
@@ -0,0 +1,298 @@
+#! /usr/bin/python3
+#
+# End to end benchmark.  Writes synthetic auth.log and mail.log traffic matching the shipped sshd and smtpd filters
+# and runs it through the real FileMonitor -> LogFilter -> publish_event -> GroupCounterTrigger -> IptablesBanTrigger
+# path with the shipped triggers.  Ban commands are recorded instead of run so this does not need root.
+#
+# Reports lines/sec, event to ban latency percentiles, SQL statements per event and peak RSS.  Each run is saved
+# under test/benchmark_results/ tagged with the current commit so runs can be compared across commits:
+#
+#     python3 test/benchmark.py --lines 5000 --attackers 200 --attack-ratio 0.5 --ipv6-ratio 0.2
+#     python3 test/benchmark.py --compare
+
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHIPPED_CONFIG = os.path.join(PROJECT_PATH, 'package', 'config')
+RESULTS_PATH = os.path.join(PROJECT_PATH, 'test', 'benchmark_results')
+
+# Lines are written in chunks, the time a chunk is flushed is the time its lines were logged
+CHUNK_SIZE = 100
+
+
+class TrafficGenerator(object):
+
+    def __init__(self, attackers, benign, attack_ratio, ipv6_ratio, seed):
+        self.random = random.Random(seed)
+        self.attack_ratio = attack_ratio
+        self.attackers = [self._address(ipv6_ratio, 'attacker', number) for number in range(attackers)]
+        self.benign = [self._address(ipv6_ratio, 'benign', number) for number in range(benign)]
+        self.session = 1000
+
+    def _address(self, ipv6_ratio, kind, number):
+        # Each IPv6 source gets its own /64 because that is what gets banned
+        if self.random.random() < ipv6_ratio:
+            prefix = 0x20010db8 if kind == 'attacker' else 0x20010db9
+            return str(ipaddress.IPv6Address((prefix << 96) | (number << 64) | self.random.getrandbits(16)))
+        network = ipaddress.IPv4Network('198.18.0.0/16' if kind == 'attacker' else '198.19.0.0/16')
+        return str(network[number + 1])
+
+    def lines(self, count, start_time):
+        # Yields (log name, line, attacker address or None)
+        for number in range(count):
+            log_time = start_time + datetime.timedelta(seconds=number // 10)
+            syslog_time = '%s %2d %s' % (log_time.strftime('%b'), log_time.day, log_time.strftime('%H:%M:%S'))
+            self.session += 1
+            port = self.random.randint(1024, 65535)
+            if self.random.random() < self.attack_ratio:
+                address = self.random.choice(self.attackers)
+                if self.random.random() < 0.5:
+                    yield 'auth.log', "%s bench sshd[%d]: Received disconnect from %s port %d:11: Bye Bye [preauth]" % (
+                        syslog_time, self.session, address, port), address
+                else:
+                    yield 'mail.log', ("%s bench postfix/smtpd[%d]: warning: unknown[%s]: SASL LOGIN authentication "
+                                       "failed: UGFzc3dvcmQ6" % (syslog_time, self.session, address)), address
+            else:
+                address = self.random.choice(self.benign)
+                if self.random.random() < 0.5:
+                    yield 'auth.log', "%s bench sshd[%d]: Accepted publickey for user%d from %s port %d ssh2" % (
+                        syslog_time, self.session, self.session % 50, address, port), None
+                else:
+                    yield 'mail.log', ("%s bench dovecot: imap-login: Login: user=<user%d>, method=PLAIN, rip=%s, "
+                                       "lip=192.0.2.1, mpid=%d, TLS, session=<s%d>" % (
+                                           syslog_time, self.session % 50, address, self.session, self.session)), None
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.base_path = tempfile.mkdtemp(prefix='logban-benchmark-')
+        self.config_path = os.path.join(self.base_path, 'config')
+        # Kept apart from logban's own log so that isn't watched too
+        self.log_paths = {name: os.path.join(self.base_path, 'logs', name) for name in ('auth.log', 'mail.log')}
+        self.ban_count = self._write_config()
+        self.generator = TrafficGenerator(options.attackers, options.benign, options.attack_ratio,
+                                          options.ipv6_ratio, options.seed)
+        # ban scope -> time the line which should have caused the ban was logged
+        self.expected_bans = {}
+        self.bans = {}
+        self.events = 0
+        self.statements = 0
+        self.lines_written = 0
+        self.write_start = None
+        self.write_end = None
+        self.finish = None
+
+    def _write_config(self):
+        os.makedirs(os.path.join(self.base_path, 'logs'))
+        for directory in ('filters', 'triggers'):
+            os.makedirs(os.path.join(self.config_path, directory))
+        with open(os.path.join(self.config_path, 'logban.conf'), 'w') as config:
+            config.write("[log]\nlevel=INFO\nlog_path=%s\n[db]\ndrivername=sqlite\ndatabase=%s\n" % (
+                os.path.join(self.base_path, 'logban.log'), os.path.join(self.base_path, 'db.sqlite3')))
+        for name in os.listdir(os.path.join(SHIPPED_CONFIG, 'filters')):
+            with open(os.path.join(SHIPPED_CONFIG, 'filters', name)) as shipped:
+                filters = shipped.read()
+            for log_name, log_path in self.log_paths.items():
+                filters = filters.replace('/var/log/' + log_name, log_path)
+            with open(os.path.join(self.config_path, 'filters', name), 'w') as copy:
+                copy.write(filters)
+        count = 5
+        for name in os.listdir(os.path.join(SHIPPED_CONFIG, 'triggers')):
+            with open(os.path.join(SHIPPED_CONFIG, 'triggers', name)) as shipped:
+                triggers = shipped.read()
+            with open(os.path.join(self.config_path, 'triggers', name), 'w') as copy:
+                copy.write(triggers)
+            found = re.search(r'^count *= *([0-9]+)', triggers, re.MULTILINE)
+            if found is not None:
+                count = int(found.group(1))
+        for log_path in self.log_paths.values():
+            open(log_path, 'w').close()
+        return count
+
+    def run(self):
+        sys.path.insert(0, PROJECT_PATH)
+        import sqlalchemy.event
+        import logban.config
+        import logban.core
+        import logban.filemonitor
+        import logban.startup
+        import logban.trigger
+
+        logban.config.load_config_files(self.config_path)
+        logban.trigger.exec_command = self._ban_backend
+        logban.startup.initialize_daemon()
+        sqlalchemy.event.listen(logban.core.DBSession._db_engine, 'before_cursor_execute', self._count_statement)
+        for config in logban.config.filter_config.values():
+            for filter_config in config:
+                logban.core.register_action(filter_config['event'], self._count_event)
+
+        self.logban = logban
+        writer = threading.Thread(target=self._write_logs, daemon=True)
+        logban.core.main_loop.call_soon(writer.start)
+        logban.core.main_loop.call_later(0.1, self._check_done)
+        logban.core.run_main_loop()
+        writer.join()
+        return self._results()
+
+    def _ban_backend(self, *args, **_):
+        if args[:3] == ('ipset', '-exist', 'add'):
+            self.bans.setdefault(args[4], time.perf_counter())
+        return 0
+
+    def _count_statement(self, *_):
+        self.statements += 1
+
+    def _count_event(self, *_, **__):
+        self.events += 1
+
+    def _write_logs(self):
+        failures = {}
+        files = {name: open(path, 'a') for name, path in self.log_paths.items()}
+        interval = 0 if not self.options.rate else CHUNK_SIZE / self.options.rate
+        start_time = datetime.datetime.now() - datetime.timedelta(seconds=self.options.lines // 10 + 60)
+        self.write_start = time.perf_counter()
+        chunk = []
+        for log_name, line, attacker in self.generator.lines(self.options.lines, start_time):
+            files[log_name].write(line + '\n')
+            chunk.append(attacker)
+            if len(chunk) == CHUNK_SIZE:
+                self._flush(files, chunk, failures)
+                chunk = []
+                if interval:
+                    time.sleep(interval)
+        self._flush(files, chunk, failures)
+        self.write_end = time.perf_counter()
+        for log_file in files.values():
+            log_file.close()
+
+    def _flush(self, files, chunk, failures):
+        for log_file in files.values():
+            log_file.flush()
+        now = time.perf_counter()
+        self.lines_written += len(chunk)
+        for attacker in chunk:
+            if attacker is not None:
+                failures[attacker] = failures.get(attacker, 0) + 1
+                if failures[attacker] == self.ban_count:
+                    self.expected_bans[_ban_scope(attacker)] = now
+
+    def _check_done(self):
+        core = self.logban.core
+        monitors = self.logban.filemonitor.all_file_monitors.values()
+        if (self.write_end is not None and core.pending_events == 0 and
+                all(monitor.file is not None and monitor.file.tell() >= os.path.getsize(monitor.file_path)
+                    for monitor in monitors)):
+            self.finish = time.perf_counter()
+            core.shutdown_main_loop()
+        else:
+            core.main_loop.call_later(0.05, self._check_done)
+
+    def _results(self):
+        latencies = sorted(self.bans[scope] - logged for scope, logged in self.expected_bans.items()
+                           if scope in self.bans)
+        duration = self.finish - self.write_start
+        return {
+            'commit': _git('rev-parse', '--short', 'HEAD'),
+            'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'options': vars(self.options),
+            'lines': self.lines_written,
+            'events': self.events,
+            'bans': len(self.bans),
+            'expected_bans': len(self.expected_bans),
+            'seconds': round(duration, 3),
+            'lines_per_second': round(self.lines_written / duration, 1),
+            'latency_ms': {'p%d' % percentile: _percentile(latencies, percentile) for percentile in (50, 90, 99)},
+            'sql_per_event': round(self.statements / self.events, 2) if self.events else None,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def _ban_scope(address):
+    # Matches how filters widen IPv6 addresses
+    if ':' in address:
+        return str(ipaddress.ip_network(address + '/64', strict=False))
+    return address
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))
+    return round(values[index] * 1000, 1)
+
+
+def _git(*args):
+    try:
+        return subprocess.run(('git',) + args, cwd=PROJECT_PATH, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def save_results(results):
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    name = "%s-%s.json" % (results['time'].replace(':', ''), results['commit'] or 'unknown')
+    with open(os.path.join(RESULTS_PATH, name), 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    return name
+
+
+def compare_results():
+    if not os.path.isdir(RESULTS_PATH):
+        print("No results in", RESULTS_PATH)
+        return
+    print("%-19s %-10s %7s %7s %9s %9s %9s %9s %8s %9s" % (
+        'time', 'commit', 'lines', 'bans', 'lines/s', 'p50 ms', 'p90 ms', 'p99 ms', 'sql/ev', 'rss kb'))
+    for name in sorted(os.listdir(RESULTS_PATH)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(RESULTS_PATH, name)) as results_file:
+            results = json.load(results_file)
+        latency = results['latency_ms']
+        print("%-19s %-10s %7d %7d %9s %9s %9s %9s %8s %9d" % (
+            results['time'], results['commit'] + ('+' if results['dirty'] else ''), results['lines'],
+            results['bans'], results['lines_per_second'], latency['p50'], latency['p90'], latency['p99'],
+            results['sql_per_event'], results['peak_rss_kb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logban end to end benchmark")
+    parser.add_argument('--lines', type=int, default=5000, help="total lines to write across both logs")
+    parser.add_argument('--attackers', type=int, default=100, help="distinct attacking addresses")
+    parser.add_argument('--benign', type=int, default=100, help="distinct benign addresses")
+    parser.add_argument('--attack-ratio', type=float, default=0.5, help="fraction of lines which are failures")
+    parser.add_argument('--ipv6-ratio', type=float, default=0.2, help="fraction of addresses which are IPv6")
+    parser.add_argument('--rate', type=float, default=0, help="lines per second to write, 0 for as fast as possible")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-save', action='store_true', help="don't store the results")
+    parser.add_argument('--compare', action='store_true', help="list stored results and exit")
+    options = parser.parse_args()
+    if options.compare:
+        compare_results()
+        return
+    benchmark = Benchmark(options)
+    results = benchmark.run()
+    print(json.dumps(results, indent=2))
+    print("Logban's own log is in", benchmark.base_path)
+    if not options.no_save:
+        print("Saved", save_results(results))
+    if results['bans'] != results['expected_bans']:
+        print("WARNING: expected %d bans but saw %d" % (results['expected_bans'], results['bans']))
+
+
+if __name__ == '__main__':
+    main()
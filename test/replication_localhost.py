@@ -0,0 +1,135 @@
+#! /usr/bin/python3
+#
+# Runs two logban nodes on localhost with replication between them and checks that:
+#  - a ban on node a is applied on node b
+#  - node b does not send the replicated ban back to node a (anti-loop)
+#  - a decision with an already applied sequence number is ignored (dedup)
+#
+# Bans are recorded to a file instead of calling ipset so this does not need root.
+#
+#     python3 test/replication_localhost.py
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NODES = {'a': 17471, 'b': 17472}
+
+
+def run_node(config_path, ban_log):
+    sys.path.insert(0, PROJECT_PATH)
+    import logban.trigger
+    import logban.startup
+
+    def record_command(*args, **_):
+        with open(ban_log, 'a') as log:
+            log.write(' '.join(args) + '\n')
+        return 0
+
+    logban.trigger.exec_command = record_command
+    sys.argv = ['logban', '--config-path=' + config_path, 'run']
+    logban.startup.main()
+
+
+def write_config(base_path, node, port, peer_port):
+    config_path = os.path.join(base_path, node)
+    for directory in ('filters', 'triggers', 'logs'):
+        os.makedirs(os.path.join(config_path, directory))
+    with open(os.path.join(config_path, 'logban.conf'), 'w') as config:
+        config.write("[log]\nlevel=INFO\n"
+                     "[db]\ndatabase=%s\n"
+                     "[replication]\nnode_id=%s\nlisten=127.0.0.1:%d\npeers=127.0.0.1:%d,\n"
+                     "batch_delay=0.1\nretry_delay=1\n" % (os.path.join(config_path, 'db.sqlite3'),
+                                                            node, port, peer_port))
+    log_path = os.path.join(config_path, 'logs', 'auth.log')
+    open(log_path, 'w').close()
+    with open(os.path.join(config_path, 'filters', 'sshd.conf'), 'w') as filters:
+        filters.write("%s | sshd_auth_fail | ^{syslog_time} {lhost} sshd\\[{session}\\]: "
+                      "Received disconnect from {rhost} port {port}:.* \\[preauth\\]$\n" % log_path)
+    with open(os.path.join(config_path, 'triggers', 'ip-ban.conf'), 'w') as triggers:
+        triggers.write("[bruit-force]\ntype = group_counter\ntrigger_events = sshd_auth_fail\n"
+                       "reset_events = sshd_auth_success\ncount = 5\ngroup_on = rhost\nresult_event = ip_bruit_force\n"
+                       "[ip-ban]\ntype = ip_ban\ntrigger_events = ip_bruit_force\n")
+    return config_path, log_path
+
+
+def send_raw(port, message):
+    with socket.create_connection(('127.0.0.1', port)) as connection:
+        connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        time.sleep(1)
+
+
+def wait_for(description, check, timeout=15):
+    end = time.time() + timeout
+    while time.time() < end:
+        if check():
+            return
+        time.sleep(0.2)
+    raise AssertionError("Timed out waiting for " + description)
+
+
+def read(path):
+    try:
+        with open(path) as file:
+            return file.read()
+    except FileNotFoundError:
+        return ''
+
+
+def main():
+    base_path = tempfile.mkdtemp(prefix='logban-replication-')
+    processes = {}
+    paths = {}
+    try:
+        for node, port in NODES.items():
+            peer_port = [other for other in NODES.values() if other != port][0]
+            config_path, log_path = write_config(base_path, node, port, peer_port)
+            output_path = os.path.join(base_path, node + '.out')
+            ban_log = os.path.join(base_path, node + '.bans')
+            paths[node] = (log_path, output_path, ban_log)
+            with open(output_path, 'w') as output:
+                processes[node] = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--node', config_path, ban_log],
+                    stdout=output, stderr=subprocess.STDOUT)
+        for node in NODES:
+            wait_for(node + " to connect", lambda: 'Connected to replication peer' in read(paths[node][1]))
+
+        # A ban on a is replicated to b
+        with open(paths['a'][0], 'a') as log:
+            for second in range(5):
+                log.write("Oct 19 10:00:0%d host sshd[1]: Received disconnect from 192.0.2.1 port 22:11: "
+                          "Bye [preauth]\n" % second)
+        wait_for("ban on b", lambda: 'add logban-ip-ban-v4 192.0.2.1' in read(paths['b'][2]))
+
+        # Anti-loop: b applied it without notifying, so nothing came back to a
+        time.sleep(1)
+        assert 'decisions from b' not in read(paths['a'][1]), "b sent a's ban back to a"
+
+        # Dedup: the same sequence from the same node and epoch is only applied once
+        until = time.time() + 3600
+        send_raw(NODES['b'], {'node': 'c', 'epoch': 1, 'bans': [[1, 'ip-ban', 'BAN', {'rhost': '192.0.2.2'}, until]]})
+        send_raw(NODES['b'], {'node': 'c', 'epoch': 1, 'bans': [[1, 'ip-ban', 'BAN', {'rhost': '192.0.2.3'}, until]]})
+        wait_for("ban from c on b", lambda: 'add logban-ip-ban-v4 192.0.2.2' in read(paths['b'][2]))
+        assert '192.0.2.3' not in read(paths['b'][2]), "duplicate sequence was applied"
+
+        # Invalid scopes never reach the ban command
+        send_raw(NODES['b'], {'node': 'c', 'epoch': 1, 'bans': [[2, 'ip-ban', 'BAN', {'rhost': '-X'}, until]]})
+        assert '-X' not in read(paths['b'][2]), "invalid rhost was applied"
+        print("OK")
+    finally:
+        for process in processes.values():
+            process.terminate()
+            process.wait(10)
+        print("Output left in", base_path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--node']:
+        run_node(*sys.argv[2:4])
+    else:
+        main()